@@ -2,8 +2,16 @@
 import os
 import time
 import json
+import hashlib
+import shutil
+import atexit
+import signal
+import textwrap
+from functools import lru_cache
 from datetime import datetime
 from threading import Thread
+from queue import Queue
+import subprocess
 from subprocess import PIPE
 
 # External library imports for Raspberry Pi hardware control
@@ -16,13 +24,17 @@ import adafruit_character_lcd.character_lcd as characterlcd
 from picamera2 import Picamera2
 from picamera2.encoders import JpegEncoder
 from PIL import Image
+import cv2
+import numpy as np
 
 # Imports for sound and voice synthesis
 from gtts import gTTS
 import pygame
 
 # Imports for machine learning and model processing
+import torch
 from transformers import BlipProcessor, BlipForConditionalGeneration
+from transformers import __version__ as transformers_version
 
 # Module for handling warnings
 import warnings
@@ -52,13 +64,53 @@ sounds = dict(
     camera = os.path.join(base_dir, "sounds", "camera-shutter.mp3"),
 )
 
+# Folder for photos, the interaction history and other generated files
+DATA_DIR = os.path.join(base_dir, "data")
+HISTORY_PATH = os.path.join(DATA_DIR, "history.jsonl")
+OLD_HISTORY_PATH = os.path.join(DATA_DIR, "history.json")  # JSON list history from earlier versions
+
+# Cache of synthesised speech files, keyed by a hash of the spoken text
+tts_cache_dir = os.path.join(DATA_DIR, "tts_cache")
+TTS_CACHE_SIZE = 100  # Maximum number of cached speech files kept on disk
+os.makedirs(tts_cache_dir, exist_ok=True)
+
+# Interaction history, appended one JSON line per caption
+history_file = open(HISTORY_PATH, "a", buffering=1)  # Line buffered
+HISTORY_FSYNC_EVERY = 10  # Number of appended entries between forced flushes to the SD card
+history_writes = 0
+history_q = Queue()       # (timestamp, caption, filename) entries waiting to be written
+
+# Offline Piper voice used for speech, gTTS is only used when the voice isn't installed
+PIPER_MODEL = os.path.join(base_dir, "models", "en_US-amy-low.onnx")
+USE_PIPER = os.path.exists(PIPER_MODEL)
+MPG123_AVAILABLE = shutil.which("mpg123") is not None  # Needed to play gTTS speech while it downloads
+
+# Model settings (set USE_INT8=0 to fall back to the full precision model)
+LLM_NAME = "Salesforce/blip-image-captioning-base"
+USE_INT8 = os.getenv("USE_INT8", "1") == "1"
+# Cached quantized model, keyed by model name and library versions so a change re-quantizes it
+INT8_CACHE_PATH = os.path.join(DATA_DIR, f"blip_int8_{LLM_NAME.replace('/', '_')}_torch{torch.__version__}_transformers{transformers_version}.pt")
+
 # GPIO setup for button input
 GPIO.setmode(GPIO.BCM)  # Set GPIO pin numbering
 GPIO.setup(BUTTON_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)  # Configure button pin with pull-up resistor
 
+# Open the audio device once and preload the fixed sound clips
+pygame.mixer.init(frequency=22050, buffer=512)
+SOUNDS = {name: pygame.mixer.Sound(path) for name, path in sounds.items()}
+last_speech_file = None  # Speech file currently loaded into the music player
+
 # Create and configure the camera
 picam2 = Picamera2()
-picam2.configure(picam2.create_preview_configuration(main={"size": (1920, 1080)}))  # Set camera resolution
+picam2.configure(picam2.create_preview_configuration(
+    main={"size": (1920, 1080)},                        # Full resolution stream for the saved photo
+    lores={"size": (384, 384), "format": "YUV420"},     # Model sized stream for captioning, scaled by the ISP
+))
+
+# Start the camera once and keep it streaming so exposure stays settled between presses
+picam2.start()
+picam2.capture_array()
+time.sleep(1)  # Allow some time for the camera to adjust settings
 
 # LCD screen setup parameters
 lcd_columns = 16  # Number of columns in the LCD display
@@ -76,46 +128,92 @@ lcd_d7 = digitalio.DigitalInOut(board.D22)
 lcd = characterlcd.Character_LCD_Mono(
     lcd_rs, lcd_en, lcd_d4, lcd_d5, lcd_d6, lcd_d7, lcd_columns, lcd_rows
 )
+LCD_PAGE_TIME = 2                             # Seconds each screen of a long message stays up
+lcd_screen = " " * (lcd_columns * lcd_rows)   # Characters currently shown on the LCD
+
+# Load the pre-trained captioning model once at startup so every press reuses it
+with torch.inference_mode():
+    LLM_PROCESSOR = BlipProcessor.from_pretrained(LLM_NAME)
+    
+    LLM_MODEL = None
+    if USE_INT8 and os.path.exists(INT8_CACHE_PATH):
+        # Reuse the previously quantized model, skipping the full precision load entirely
+        try:
+            LLM_MODEL = torch.load(INT8_CACHE_PATH, weights_only=False)
+        except Exception as e:
+            print(f"An error occurred: {e}")    # Unreadable cache, rebuild it below
+    
+    if LLM_MODEL is None:
+        LLM_MODEL = BlipForConditionalGeneration.from_pretrained(LLM_NAME)
+        LLM_MODEL.eval()
+        
+        if USE_INT8:
+            # Quantize the linear layers to INT8 so the matmuls run on the ARM int8 kernels, and cache them for the next start
+            LLM_MODEL = torch.quantization.quantize_dynamic(LLM_MODEL, {torch.nn.Linear}, dtype=torch.qint8)
+            
+            # Write to a temporary file so a power cut mid-save never leaves a broken cache
+            torch.save(LLM_MODEL, INT8_CACHE_PATH + ".part")
+            os.replace(INT8_CACHE_PATH + ".part", INT8_CACHE_PATH)
+    
+    # Warm up the model so the first real caption doesn't pay the lazy kernel initialisation cost
+    LLM_MODEL.generate(**LLM_PROCESSOR(Image.new("RGB", (384, 384)), return_tensors="pt"), max_new_tokens=1)
+
+# Reusable model input buffer and normalisation constants, so captioning skips the processor
+LLM_IMAGE_SIZE = 384
+PIXEL_BUF = torch.empty(1, 3, LLM_IMAGE_SIZE, LLM_IMAGE_SIZE)
+PIXEL_MEAN = torch.tensor(LLM_PROCESSOR.image_processor.image_mean).view(3, 1, 1)
+PIXEL_STD = torch.tensor(LLM_PROCESSOR.image_processor.image_std).view(3, 1, 1)
 
 # Variables to track the state of the button
-prev_button_state = GPIO.LOW  # Previous state from the input pin
-button_state = None           # Current reading from the input pin
 press_time_start = 0          # Start time of a button press
-press_time_end = 0            # End time of a button press
+
+# Queues connecting the pipeline stages (button -> capture -> analyse -> speech/LCD)
+capture_q = Queue()   # Timestamps of short presses waiting for a photo
+caption_q = Queue()   # (timestamp, filename, image) triples waiting for a caption
+speak_q = Queue()     # (message, sound name or None) pairs waiting to be shown and played
+
+
 
 
 
 
+def save_image(array, filename):
+    """Saves a captured frame as a PNG file for the history log."""
+    # The camera's frames are already RGB with a padding byte, slicing it off avoids a colour conversion
+    Image.fromarray(array[..., :3]).save(f"{base_dir}/{filename}", optimize=False, compress_level=1)
+
 
 
 def capture_image(filename):
-    """Captures an image from the connected camera and saves it as a file."""
-    # Start the camera
-    picam2.start()
-    
-    # Allow some time for the camera to adjust settings
-    time.sleep(1)  # Sleep for 1 second
+    """Captures an image from the running camera, saving it as a file in the background."""
+    # Capture the full and model sized versions of the same frame straight into memory
+    (array, lores), _ = picam2.capture_arrays(["main", "lores"])
     
-    # Capture the image
-    picam2.capture_file(filename)
+    # Write the photo to disk without holding up the caption
+    Thread(target=save_image, args=(array, filename)).start()
     
-    # Stop the camera
-    picam2.stop()
+    # The Pi's low resolution stream is always YUV420, convert it to RGB for the model
+    return Image.fromarray(cv2.cvtColor(lores, cv2.COLOR_YUV420p2RGB))
 
 
 
-def analyse_image(filename):
-    """Processes an image file to generate a caption using a pre-trained model."""
-    # Load pre-trained models
-    llm_processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
-    llm_model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base")
-    
+def analyse_image(raw_image):
+    """Processes a captured image to generate a caption using the pre-loaded model."""
     try:
-        # Open and process the image
-        with Image.open(os.path.join(base_dir, filename)).convert('RGB') as raw_image:
-            inputs = llm_processor(raw_image, return_tensors="pt")
-            outputs = llm_model.generate(**inputs)
-            caption = llm_processor.decode(outputs[0], skip_special_tokens=True)
+        # The camera already delivers the model's input size, only resize if it doesn't
+        if raw_image.size != (LLM_IMAGE_SIZE, LLM_IMAGE_SIZE):
+            raw_image = raw_image.resize((LLM_IMAGE_SIZE, LLM_IMAGE_SIZE), Image.BICUBIC)
+        
+        # Greedy decoding without autograd tracking
+        with torch.inference_mode():
+            # Normalise the image straight into the preallocated buffer
+            pixels = PIXEL_BUF[0]
+            pixels.copy_(torch.from_numpy(np.asarray(raw_image)).permute(2, 0, 1))
+            pixels.div_(255).sub_(PIXEL_MEAN).div_(PIXEL_STD)
+            
+            # Short captions are plenty for speech, decode them greedily reusing the key/value cache
+            outputs = LLM_MODEL.generate(pixel_values=PIXEL_BUF, max_new_tokens=15, num_beams=1, do_sample=False, use_cache=True)
+        caption = LLM_PROCESSOR.decode(outputs[0], skip_special_tokens=True)
         
         return caption
     
@@ -127,70 +225,229 @@ def analyse_image(filename):
 
 def play_sound(musicName):
     """Plays a sound file from the sounds dictionary."""
-    #  Play the audio file
-    pygame.mixer.init()
-    pygame.mixer.music.load(sounds.get(musicName))
-    pygame.mixer.music.play()
+    #  Play the preloaded audio clip
+    SOUNDS[musicName].play()
     
-    while pygame.mixer.music.get_busy():
-        pygame.time.Clock().tick(10)        # Wait for the audio to finish playing
+    while pygame.mixer.get_busy():
+        time.sleep(0.05)                    # Wait for the audio to finish playing
+
+
+
+def trim_tts_cache():
+    """Removes the least recently used speech files once the cache grows too large."""
+    files = [f"{tts_cache_dir}/{name}" for name in os.listdir(tts_cache_dir)]
+    if len(files) > TTS_CACHE_SIZE:
+        files.sort(key=os.path.getatime)
+        for path in files[:len(files) - TTS_CACHE_SIZE]:
+            os.remove(path)
+
+
+
+def get_speech_path(speech_text):
+    """Returns the cache path of the speech file for the text."""
+    key = hashlib.sha1(speech_text.encode()).hexdigest()
+    return f"{tts_cache_dir}/{key}.wav" if USE_PIPER else f"{tts_cache_dir}/{key}.mp3"
+
+
+
+def get_speech_file(speech_text):
+    """Returns the path of the speech file for the text, synthesising it only if it isn't cached."""
+    path = get_speech_path(speech_text)
+    
+    if not os.path.exists(path):
+        # Write to a temporary file so a failed synthesis never leaves a broken cache entry
+        try:
+            if USE_PIPER:
+                # Synthesise locally with Piper, no network round-trip needed
+                subprocess.run(["piper", "--model", PIPER_MODEL, "--output_file", path + ".part"], input=speech_text, text=True, check=True)
+            else:
+                gTTS(text=speech_text, lang='en').save(path + ".part")
+        except Exception:
+            if os.path.exists(path + ".part"):
+                os.remove(path + ".part")
+            raise
+        
+        os.replace(path + ".part", path)
+        trim_tts_cache()
+    
+    return path
+
+
+
+def stream_speech(speech_text, path):
+    """Plays gTTS speech while it downloads and caches it, returning whether playback finished."""
+    player = subprocess.Popen(["mpg123", "-q", "-"], stdin=PIPE)
+    played = True
+    
+    # Write to a temporary file so a failed download never leaves a broken cache entry
+    try:
+        with open(path + ".part", "wb") as file:
+            for chunk in gTTS(text=speech_text, lang='en').stream():
+                file.write(chunk)
+                if played:
+                    try:
+                        player.stdin.write(chunk)
+                    except BrokenPipeError:
+                        played = False      # The player exited early, keep downloading so it can be replayed
+    except Exception:
+        if os.path.exists(path + ".part"):
+            os.remove(path + ".part")
+        raise
+    finally:
+        try:
+            player.stdin.close()
+        except BrokenPipeError:
+            played = False
+        player.wait()                       # Wait for the audio to finish playing
+    
+    os.replace(path + ".part", path)
+    trim_tts_cache()
+    
+    return played and player.returncode == 0
 
 
 
 def convert_text_to_speech(speech_text):
     """Converts text to speech and plays it back."""
-    tts = gTTS(text=speech_text, lang='en')
-    tts.save("speech.mp3")
+    global last_speech_file
+    path = get_speech_path(speech_text)
+    
+    # Start speaking uncached gTTS text as soon as the first bytes arrive
+    if not USE_PIPER and not os.path.exists(path) and MPG123_AVAILABLE:
+        if stream_speech(speech_text, path):
+            return
+    
+    path = get_speech_file(speech_text)
     
-    #  Play the audio file
-    pygame.mixer.init()
-    pygame.mixer.music.load("speech.mp3")
+    #  Play the audio file, only loading it if it isn't already in the music player
+    if path != last_speech_file:
+        pygame.mixer.music.load(path)
+        last_speech_file = path
     pygame.mixer.music.play()
     
     while pygame.mixer.music.get_busy():
-        pygame.time.Clock().tick(10)        # Wait for the audio to finish playing
+        time.sleep(0.05)                    # Wait for the audio to finish playing
+
+
+
+@lru_cache(maxsize=32)
+def format_lcd(txt):
+    """Wraps text at word boundaries into LCD screens, each padded to exactly fill the display."""
+    lines = [line.ljust(lcd_columns) for line in textwrap.wrap(txt, lcd_columns)] or [" " * lcd_columns]
+    lines += [" " * lcd_columns] * (-len(lines) % lcd_rows)
     
-    # Delete the audio file
-    os.remove("speech.mp3")
+    return tuple("".join(lines[i:i + lcd_rows]) for i in range(0, len(lines), lcd_rows))
 
 
 
-def display_message(txt, sleep_time=0):
-    """Displays a message on the LCD with a left scrolling effect."""
+def draw_screen(screen):
+    """Writes only the characters that differ from what the LCD is currently showing."""
+    global lcd_screen
+    
+    for row in range(lcd_rows):
+        offset = row * lcd_columns
+        col = 0
+        while col < lcd_columns:
+            if screen[offset + col] == lcd_screen[offset + col]:
+                col += 1
+                continue
+            
+            # Send the whole run of changed characters in one go
+            end = col
+            while end < lcd_columns and screen[offset + end] != lcd_screen[offset + end]:
+                end += 1
+            lcd.cursor_position(col, row)
+            lcd.message = screen[offset + col:offset + end]
+            col = end
+    
+    lcd_screen = screen
+
+
+
+def clear_display():
+    """Clears the LCD and resets the record of what it is showing."""
+    global lcd_screen
     lcd.clear()
-    txt = txt.strip() + ' '                 # Ensure there's a space after the text
-    n = lcd_columns
+    lcd_screen = " " * (lcd_columns * lcd_rows)
+
+
+
+def display_message(txt, sleep_time=0):
+    """Displays a message on the LCD, paging through it a screen at a time."""
+    screens = format_lcd(txt.strip())
     
-    while True:
-        lcd.clear()                         # Clear the display to update the scrolling text
-        sleep(0.1)
-        lcd.message = txt[:lcd_columns]     # Show the first part of the text on the LCD
-        sleep(0.2)                          # Delay to control the speed of the scroll
-        txt = txt[1:] + txt[0]              # Rotate text to the left
-        
-        if n >= len(txt): 
-            break
-        n += 1
+    for n, screen in enumerate(screens):
+        draw_screen(screen)
+        if n < len(screens) - 1:
+            sleep(LCD_PAGE_TIME)            # Give the user time to read before the next screen
     
     if sleep_time > 0:
         sleep(sleep_time)
-        lcd.clear()
+        clear_display()
 
 
 
-def save_user_interaction(current_time, caption, filename):
-    with open(os.path.join(base_dir, "data", "history.json"), "r") as file:
-        data = json.load(file)
+def write_user_interaction(current_time, caption, filename):
+    """Appends an interaction to the history file."""
+    global history_writes
     
-    # Append the new data to the existing list
-    data.append(dict(
+    history_file.write(json.dumps(dict(
         createdAt = current_time.isoformat(),
         caption = caption,
         filename = filename
-    ))
+    )) + "\n")
     
-    # Save the updated data to the file
-    json.dump(data, open(os.path.join(base_dir, "data", "history.json"), "w"))
+    # Only force the data onto the SD card every few entries
+    history_writes += 1
+    if history_writes % HISTORY_FSYNC_EVERY == 0:
+        os.fsync(history_file.fileno())
+
+
+
+def history_worker():
+    """Writes queued interactions to the history file in the background."""
+    while True:
+        entry = history_q.get()
+        try:
+            write_user_interaction(*entry)
+        except Exception as e:
+            print(f"An error occurred: {e}")
+        finally:
+            history_q.task_done()               # Always mark the entry done so the exit flush can't hang
+
+
+
+def flush_history():
+    """Waits for queued interactions to be written and forces them onto the SD card."""
+    history_q.join()
+    history_file.flush()
+    os.fsync(history_file.fileno())
+
+
+
+def migrate_old_history():
+    """Carries over entries from the old JSON list history so they still get uploaded."""
+    if not os.path.exists(OLD_HISTORY_PATH):
+        return
+    
+    try:
+        with open(OLD_HISTORY_PATH) as file:
+            entries = json.load(file)
+    except (OSError, ValueError) as e:
+        # Leave the file in place for a manual look rather than refusing to boot
+        print(f"An error occurred: {e}")
+        return
+    
+    for entry in entries:
+        history_file.write(json.dumps(entry) + "\n")
+    os.fsync(history_file.fileno())
+    os.remove(OLD_HISTORY_PATH)
+
+
+
+def save_user_interaction(current_time, caption, filename):
+    """Queues an interaction to be saved without waiting on the SD card."""
+    history_q.put((current_time, caption, filename))
 
 
 
@@ -207,59 +464,98 @@ def process_two_functions_with_threading(func1, args1, func2, args2):
 
 
 
-def main():
-    """Main function to handle button press logic and process image."""
-    global prev_button_state, press_time_start, press_time_end
+def on_button_change(channel):
+    """Handles button edges and queues a capture for every short press."""
+    global press_time_start
     
-    # Read the state of the switch/button
-    button_state = GPIO.input(BUTTON_PIN)
-    time.sleep(DEBOUNCE_TIME)   # Sleep to debounce the button
-
     # Detect button press
-    if prev_button_state == GPIO.HIGH and button_state == GPIO.LOW:  # Button is pressed
+    if GPIO.input(BUTTON_PIN) == GPIO.LOW:  # Button is pressed
         press_time_start = time.time()
-    elif prev_button_state == GPIO.LOW and button_state == GPIO.HIGH:  # Button is released
-        press_time_end = time.time()
-        press_duration = press_time_end - press_time_start
+    else:                                   # Button is released
+        press_duration = time.time() - press_time_start
         
         # Check if the duration of a button press is short
         if press_duration < SHORT_PRESS_TIME:
             # Record the current time when the button press was registered
-            current_time = datetime.now()
-            # Construct a filename for saving the photo with a timestamp
-            filename = os.path.join("data", f"photo_{current_time.strftime('%Y%m%d_%H%M%S')}.png")
-            
-            # Capture an image using the constructed filename
-            capture_image(filename=filename)
-            # Simultaneously display a message on the LCD and play a sound
-            process_two_functions_with_threading(display_message, ("Smile for the camera!",), play_sound, ("camera",))
-            
-            # Display a processing message and convert the displayed text to speech concurrently
-            process_two_functions_with_threading(convert_text_to_speech, ("Processing image...",), display_message, ("Processing image...",))
-            # Analyze the captured image and retrieve a caption
-            caption = analyse_image(filename=filename)
-            # Log this interaction for future reference or analysis
-            save_user_interaction(current_time, caption, filename)
-            
-            # Display the image caption and play a sound indicating the end of the process
-            process_two_functions_with_threading(convert_text_to_speech, (caption,), display_message, (caption,))
-            
-            # Clear any previous messages from the LCD
-            lcd.clear()
-            # Prepare the system for the next interaction by indicating readiness
-            process_two_functions_with_threading(display_message, ("Ready...",), play_sound, ("start",))
+            capture_q.put(datetime.now())
+
+
+
+def capture_worker():
+    """Takes a photo for every queued button press."""
+    while True:
+        current_time = capture_q.get()
+        # Construct a filename for saving the photo with a timestamp
+        filename = f"data/photo_{current_time:%Y%m%d_%H%M%S_%f}.png"  # Microseconds keep quick repeat presses apart
+        
+        # Capture an image using the constructed filename
+        raw_image = capture_image(filename=filename)
+        # Let the user know the photo was taken and is being processed
+        speak_q.put(("Smile for the camera!", "camera"))
+        speak_q.put(("Processing image...", None))
+        
+        # Hand the photo over to the analysis stage
+        caption_q.put((current_time, filename, raw_image))
+
+
+
+def analyse_worker():
+    """Generates a caption for every captured photo."""
+    # Leave one core free for the GPIO, camera and audio threads
+    torch.set_num_threads(3)
     
-    prev_button_state = button_state
+    while True:
+        current_time, filename, raw_image = caption_q.get()
+        # Analyze the captured image and retrieve a caption
+        caption = analyse_image(raw_image=raw_image)
+        # Log this interaction for future reference or analysis
+        save_user_interaction(current_time, caption, filename)
+        
+        # Read out the caption and indicate readiness for the next interaction
+        speak_q.put((caption, None))
+        speak_q.put(("Ready...", "start"))
+
+
+
+def tts_worker():
+    """Shows each queued message on the LCD while playing its sound or speech."""
+    while True:
+        message, music_name = speak_q.get()
+        if music_name:
+            process_two_functions_with_threading(display_message, (message,), play_sound, (music_name,))
+        else:
+            process_two_functions_with_threading(convert_text_to_speech, (message,), display_message, (message,))
 
 
 
 if __name__ == "__main__":
     try:
-        lcd.clear()
+        clear_display()
+        migrate_old_history()
+        
+        # Synthesise the fixed messages up front so they play without a network round-trip
+        for text in ("Smile for the camera!", "Processing image..."):
+            try:
+                get_speech_file(text)
+            except Exception as e:
+                print(f"An error occurred: {e}")
+        
         process_two_functions_with_threading(display_message, ("Ready...",), play_sound, ("start",))
+        
+        # Start the pipeline stages in the background
+        workers = [Thread(target=worker, daemon=True) for worker in (capture_worker, analyse_worker, tts_worker, history_worker)]
+        for worker in workers:
+            worker.start()
+        # Make sure the queued history is written out on exit
+        atexit.register(flush_history)
+        
+        # Listen for button presses and releases without polling
+        GPIO.add_event_detect(BUTTON_PIN, GPIO.BOTH, callback=on_button_change, bouncetime=int(DEBOUNCE_TIME * 1000))
+        # Sleep until a signal arrives, all the work happens in the callback and worker threads
         while True:
-            main()
+            signal.pause()
         
     except KeyboardInterrupt:
+        picam2.stop()
         GPIO.cleanup()
         display_message("Exiting...", 5)
\ No newline at end of file
@@ -1,6 +1,7 @@
 import os
 import time
 import warnings
+import torch
 from PIL import Image
 from transformers import BlipProcessor, BlipForConditionalGeneration
 
@@ -10,35 +11,46 @@ base_dir = os.path.dirname(os.path.abspath(__file__))
 processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
 model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base")
 
+# Use half precision on a GPU, otherwise INT8 linear layers across every CPU core
+device = "cuda" if torch.cuda.is_available() else "cpu"
+if device == "cuda":
+    model = model.half().eval().to(device)
+else:
+    model = torch.quantization.quantize_dynamic(model.eval(), {torch.nn.Linear}, dtype=torch.qint8)
+    torch.set_num_threads(os.cpu_count())
+
 images = [
     "photo_rasp.png",
     # "photo2.png",
     # "photo3.png"
 ]
 
-total_time = 0  # Initialize a variable to keep track of the total time
-
-for n, image in enumerate(images):
-    start_time = time.time()  # Record the start time
+start_time = time.time()  # Record the start time
 
+# Open all the image files so they can be captioned as one batch
+raw_images = []
+for image in images:
     image_path = os.path.join(base_dir, image)
-
-    # Open the image file and process it
     with open(image_path, "rb") as f:
-        raw_image = Image.open(f).convert('RGB')
+        raw_images.append(Image.open(f).convert('RGB'))
+
+inputs = processor(images=raw_images, return_tensors="pt", padding=True).to(device)
+if device == "cuda":
+    inputs["pixel_values"] = inputs["pixel_values"].half()
 
-    inputs = processor(raw_image, return_tensors="pt")
-    out = model.generate(**inputs)
+with torch.inference_mode():
+    out = model.generate(**inputs, num_beams=1)
+captions = processor.batch_decode(out, skip_special_tokens=True)
 
-    # Calculate the time taken to process the image
-    elapsed_time = time.time() - start_time
-    total_time += elapsed_time  # Add the elapsed time to the total time
+# Calculate the time taken to process the whole batch
+total_time = time.time() - start_time
 
-    # Output the caption and the time taken for processing this image
+# Output the caption for each image
+for n, caption in enumerate(captions):
     print(f"\nImage {n+1}:")
-    print(processor.decode(out[0], skip_special_tokens=True))
-    print(f"Processing time: {elapsed_time:.2f} seconds")
+    print(caption)
 
 # Calculate the average processing time
 avg_time = total_time / len(images)
-print(f"\nAverage processing time: {avg_time:.2f} seconds")
+print(f"\nTotal processing time: {total_time:.2f} seconds")
+print(f"Average processing time: {avg_time:.2f} seconds")
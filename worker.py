@@ -67,9 +67,17 @@ def main():
         print(f"An error occurred: {e}")
     
 
-    # Load history data from JSON file
-    with open(os.path.join(base_dir, "data", "history.json")) as file:
-        history = json.load(file)
+    # Load history data from JSON lines file
+    with open(os.path.join(base_dir, "data", "history.jsonl")) as file:
+        history = []
+        for line in file:
+            if not line.strip():
+                continue
+            try:
+                history.append(json.loads(line))
+            except json.JSONDecodeError as e:
+                # A torn line from a power cut shouldn't stop the rest from uploading
+                print(f"Skipping unreadable history entry {line!r}: {e}")
 
     # Process each history entry
     for entry in history:
@@ -87,9 +95,8 @@ def main():
         # Remove the picture after uploading
         os.remove(entry["filename"])
 
-    # Clear the history in the JSON file
-    with open(os.path.join(base_dir, "data", "history.json"), "w") as file:
-        json.dump([], file)
+    # Clear the history in the JSON lines file
+    open(os.path.join(base_dir, "data", "history.jsonl"), "w").close()
 
 
 